@@ -8,10 +8,12 @@ import os
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))  # Lower to 10 if logins are CPU-bound
 
 pwd_context = CryptContext(
     schemes=["bcrypt_sha256"],  # <-- handles long passwords safely
-    deprecated="auto"
+    deprecated="auto",
+    bcrypt_sha256__rounds=BCRYPT_ROUNDS
 )
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -22,6 +24,9 @@ def get_password_hash(password: str) -> str:
 
     return pwd_context.hash(password)
 
+# Verified against when the user doesn't exist, so every login costs one bcrypt check
+DUMMY_HASH = get_password_hash("x" * 16)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
 
     to_encode = data.copy()
@@ -1,22 +1,56 @@
-from sqlalchemy import create_engine
+from sqlalchemy import Connection, MetaData, inspect
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 import os
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./chat_app.db")
 
-engine = create_engine(
-    DATABASE_URL,
-    connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
+def get_async_url(url: str) -> str:
+
+    # Swap the default sync drivers for their asyncio counterparts
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return url
+
+ASYNC_DATABASE_URL = get_async_url(DATABASE_URL)
+
+engine = create_async_engine(
+    ASYNC_DATABASE_URL,
+    **({} if "sqlite" in ASYNC_DATABASE_URL else {"pool_size": 5, "max_overflow": 10})
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = async_sessionmaker(
+    bind=engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False
+)
 
 Base = declarative_base()
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
\ No newline at end of file
+def migrate_schema(connection: Connection, metadata: MetaData):
+
+    # create_all skips existing tables, so add any columns and indexes they are missing
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    for table in metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            # Only nullable columns are ever added, so existing rows need no default
+            column_type = column.type.compile(dialect=connection.dialect)
+            connection.exec_driver_sql(
+                f"ALTER TABLE {preparer.format_table(table)} "
+                f"ADD COLUMN {preparer.format_column(column)} {column_type}"
+            )
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+
+async def get_db():
+    async with SessionLocal() as db:
+        yield db
\ No newline at end of file
@@ -1,16 +1,93 @@
 from fastapi import UploadFile, HTTPException
+from fastapi.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from PIL import Image, ImageOps
+import asyncio
+import io
 import os
-import uuid
+import secrets
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Optional
+
+try:
+    import aiofiles
+except ImportError:  # Fall back to writing through the default executor
+    aiofiles = None
 
 # Configuration
 UPLOAD_DIR = "uploads"
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
-ALLOWED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
+ALLOWED_EXTENSIONS = frozenset({".jpg", ".jpeg", ".png", ".gif", ".webp"})
+MAX_FORM_OVERHEAD = 64 * 1024  # Room for multipart boundaries and the text field
+FILE_TOO_LARGE_DETAIL = f"File too large. Maximum size: {MAX_FILE_SIZE / 1024 / 1024}MB"
+
+# Stored images are downscaled and re-encoded to cut disk usage and Gemini image tokens
+STORED_IMAGE_DIMENSION = 1568
+STORED_IMAGE_FORMAT = "webp"
+STORED_IMAGE_EXTENSION = ".webp"
+STORED_IMAGE_QUALITY = 85
+
+UPLOAD_PATH = Path(UPLOAD_DIR)
 
 # Create upload directory if it doesn't exist
-Path(UPLOAD_DIR).mkdir(parents=True, exist_ok=True)
+UPLOAD_PATH.mkdir(parents=True, exist_ok=True)
+
+class UploadSizeLimitMiddleware:
+    """Reject request bodies over the upload limit before the form is parsed"""
+
+    def __init__(self, app: ASGIApp, max_body_size: int = MAX_FILE_SIZE + MAX_FORM_OVERHEAD):
+        self.app = app
+        self.max_body_size = max_body_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        # Fail on the declared length without reading any of the body
+        content_length = dict(scope["headers"]).get(b"content-length", b"")
+        if content_length.isdigit() and int(content_length) > self.max_body_size:
+            response = JSONResponse({"detail": FILE_TOO_LARGE_DETAIL}, status_code=413)
+            await response(scope, receive, send)
+            return
+        
+        # Otherwise count the body as it arrives; the route turns this into a 413
+        received = 0
+        
+        async def limited_receive() -> Message:
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_size:
+                    raise HTTPException(status_code=413, detail=FILE_TOO_LARGE_DETAIL)
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+def _write_sync(path: Path, data: memoryview):
+
+    with open(path, "wb") as buffer:
+        buffer.write(data)
+
+def _reencode_sync(source: BinaryIO) -> io.BytesIO:
+
+    # The body is already spooled, so its size is a seek away
+    if source.seek(0, os.SEEK_END) > MAX_FILE_SIZE:
+        raise HTTPException(status_code=413, detail=FILE_TOO_LARGE_DETAIL)
+    source.seek(0)
+    
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((STORED_IMAGE_DIMENSION, STORED_IMAGE_DIMENSION))
+        
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or "A" in image.mode else "RGB")
+        
+        output = io.BytesIO()
+        image.save(output, STORED_IMAGE_FORMAT, quality=STORED_IMAGE_QUALITY, method=4)
+    
+    return output
 
 async def save_uploaded_image(
     file: UploadFile,
@@ -26,33 +103,36 @@ async def save_uploaded_image(
             detail=f"Invalid file type. Allowed types: {', '.join(ALLOWED_EXTENSIONS)}"
         )
     
-    # Check file size
-    file.file.seek(0, 2)  # Seek to end
-    file_size = file.file.tell()  # Get position (file size)
-    file.file.seek(0)  # Reset to beginning
-    
-    if file_size > MAX_FILE_SIZE:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File too large. Maximum size: {MAX_FILE_SIZE / 1024 / 1024}MB"
-        )
-    
-    # Generate unique filename
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
+    # Generate unique filename; stored images are always re-encoded
+    unique_filename = f"{secrets.token_urlsafe(16)}{STORED_IMAGE_EXTENSION}"
     
     # Create user-specific directory structure
-    user_dir = Path(UPLOAD_DIR) / str(user_id) / str(session_id)
+    user_dir = UPLOAD_PATH / str(user_id) / str(session_id)
     user_dir.mkdir(parents=True, exist_ok=True)
     
     # Full path to save file
     file_path = user_dir / unique_filename
     
-    # Save file
+    # Check the size, downscale and re-encode off the event loop. PIL reads the
+    # spooled upload directly, so it is never held in memory as a whole.
+    loop = asyncio.get_running_loop()
+    try:
+        encoded = await loop.run_in_executor(None, _reencode_sync, file.file)
+    except HTTPException:
+        raise
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    
+    # Save file, handing over a view of the encoded buffer rather than a copy
     try:
-        with open(file_path, "wb") as buffer:
-            content = await file.read()
-            buffer.write(content)
+        with encoded.getbuffer() as data:
+            if aiofiles is not None:
+                async with aiofiles.open(file_path, "wb") as buffer:
+                    await buffer.write(data)
+            else:
+                await loop.run_in_executor(None, _write_sync, file_path, data)
     except Exception as e:
+        file_path.unlink(missing_ok=True)
         raise HTTPException(
             status_code=500,
             detail=f"Failed to save file: {str(e)}"
@@ -62,12 +142,16 @@ async def save_uploaded_image(
 
 def delete_session_images(user_id: int, session_id: int):
 
-    session_dir = Path(UPLOAD_DIR) / str(user_id) / str(session_id)
+    session_dir = UPLOAD_PATH / str(user_id) / str(session_id)
     
     if session_dir.exists():
         import shutil
         shutil.rmtree(session_dir)
 
+def delete_image(image_path: str):
+
+    Path(image_path).unlink(missing_ok=True)
+
 def get_image_url(image_path: str) -> str:
 
     return f"/api/images/{image_path.replace(UPLOAD_DIR + '/', '')}"
\ No newline at end of file
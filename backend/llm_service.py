@@ -1,8 +1,20 @@
 import google.generativeai as genai
-from PIL import Image
+from cachetools import TTLCache
+from google.api_core.exceptions import InternalServerError, ResourceExhausted, ServiceUnavailable
+from google.generativeai import caching
+from PIL import Image, ImageOps
+import asyncio
+import io
+import mimetypes
 import os
-from typing import List, Optional
-from models import Message
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import AsyncIterator, List, Optional, Tuple
+from models import ChatSession, Message
+from rate_limiter import RateLimiter
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+from file_handler import STORED_IMAGE_DIMENSION, STORED_IMAGE_FORMAT, STORED_IMAGE_QUALITY
 from dotenv import load_dotenv
 
 load_dotenv() 
@@ -30,33 +42,195 @@ safety_settings = [
 ]
 
 # Initialize model
+# Context caching requires an explicit model version
+MODEL_NAME = "models/gemini-1.5-flash-002"
+
 model = genai.GenerativeModel(
-    model_name="gemini-1.5-flash",
+    model_name=MODEL_NAME,
     generation_config=generation_config,
     safety_settings=safety_settings
 )
 
-def load_image(image_path: str) -> Image.Image:
 
-    return Image.open(image_path)
+# Limit on history images decoded at once
+IMAGE_LOAD_CONCURRENCY = 8
+image_load_semaphore = asyncio.Semaphore(IMAGE_LOAD_CONCURRENCY)
+
+# Client-side limits to stay under the Gemini quota instead of hitting 429s
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "15"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "1000000"))
+GEMINI_RPD = int(os.getenv("GEMINI_RPD", "1500"))
+GEMINI_IPM = int(os.getenv("GEMINI_IPM", str(GEMINI_RPM)))
+
+# Requests being started at once; held only until the first chunk, never while streaming
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+
+gemini_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+rate_limiter = RateLimiter(rpm=GEMINI_RPM, tpm=GEMINI_TPM, rpd=GEMINI_RPD, ipm=GEMINI_IPM)
+image_lock = asyncio.Lock()  # Image-bearing turns are started one at a time
+
+# Retry rate limits and transient server errors with exponential backoff
+RETRYABLE_ERRORS = (ResourceExhausted, ServiceUnavailable, InternalServerError)
+MAX_ATTEMPTS = 5
+
+# Context caching for long histories
+CACHE_VERSION = 1  # Bump when the model, prompts or generation settings change
+CACHE_MIN_MESSAGES = 4
+CACHE_MIN_TOKENS = 32768  # Gemini rejects caches smaller than this
+CACHE_TTL = timedelta(hours=1)
+IMAGE_TOKEN_ESTIMATE = 258
+
+# History sent per turn: a summary of older messages plus the recent ones verbatim.
+# Once SUMMARY_BATCH messages have fallen out of the last HISTORY_WINDOW, they
+# are folded into the summary.
+HISTORY_WINDOW = 20
+SUMMARY_BATCH = 10
+SUMMARY_PROMPT = (
+    "Summarize the conversation below so it can stand in for it as context in later turns. "
+    "Keep facts, names, decisions, and open questions. Be concise."
+)
+
+# Gemini chats kept in process so follow-up turns only send the new message,
+# bounded by the size of their history since it can hold inline images
+CHAT_VERSION = 1
+CHAT_CACHE_BYTES = int(os.getenv("CHAT_CACHE_BYTES", str(64 * 1024 * 1024)))
+CHAT_CACHE_TTL = 30 * 60  # Idle chats are rebuilt from the database
+
+def get_chat_size(entry: Tuple[tuple, genai.ChatSession]) -> int:
+
+    _, chat = entry
+    try:
+        return sum(type(content).pb(content).ByteSize() for content in chat.history) or 1
+    except Exception:
+        return 1  # Unusable history is replaced on the next turn
+
+chat_sessions = TTLCache(maxsize=CHAT_CACHE_BYTES, ttl=CHAT_CACHE_TTL, getsizeof=get_chat_size)
+
+# Uploaded files are kept by Gemini for 48 hours
+FILE_VERSION = 1
+FILE_TTL = timedelta(hours=47)
 
-def build_message_history(chat_history: List[Message]) -> List[dict]:
+@lru_cache(maxsize=64)
+def _load_image_cached(image_path: str, mtime: float) -> dict:
+
+    with Image.open(image_path) as image:
+        # Images stored since uploads are re-encoded are sent as-is
+        if image.format == "WEBP" and max(image.size) <= STORED_IMAGE_DIMENSION:
+            with open(image_path, "rb") as f:
+                return {"mime_type": "image/webp", "data": f.read()}
+        
+        # Older uploads are kept as sent, so bound them the same way before sending
+        image = ImageOps.exif_transpose(image)
+        image = ImageOps.contain(image, (STORED_IMAGE_DIMENSION, STORED_IMAGE_DIMENSION))
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or "A" in image.mode else "RGB")
+        
+        output = io.BytesIO()
+        image.save(output, STORED_IMAGE_FORMAT, quality=STORED_IMAGE_QUALITY, method=4)
+    
+    return {"mime_type": "image/webp", "data": output.getvalue()}
+
+def load_image(image_path: str) -> dict:
+
+    # Key on mtime so a replaced file is never served from the cache
+    return _load_image_cached(image_path, os.path.getmtime(image_path))
+
+async def upload_image(image_path: str, message: Message):
+
+    # Named after the stored file, since the message has no id until the turn is committed
+    file_token = os.path.splitext(os.path.basename(image_path))[0]
+    try:
+        uploaded = await asyncio.to_thread(
+            genai.upload_file,
+            image_path,
+            display_name=f"v{FILE_VERSION}-img:{file_token}"
+        )
+    except Exception as e:
+        print(f"Error uploading image: {e}")
+        return
+    
+    message.gemini_file_name = uploaded.name
+    message.gemini_file_uri = uploaded.uri
+    message.gemini_file_expires_at = datetime.utcnow() + FILE_TTL
+
+async def delete_uploaded_image(file_name: str):
+
+    try:
+        await asyncio.to_thread(genai.delete_file, file_name)
+    except Exception as e:
+        print(f"Error deleting uploaded image: {e}")
+
+def has_uploaded_file(message: Message) -> bool:
+
+    return (
+        message.gemini_file_uri is not None
+        and message.gemini_file_expires_at is not None
+        and message.gemini_file_expires_at > datetime.utcnow()
+    )
+
+def get_file_part(message: Message) -> dict:
+
+    mime_type, _ = mimetypes.guess_type(message.image_path)
+    return {
+        "file_data": {
+            "mime_type": mime_type or "application/octet-stream",
+            "file_uri": message.gemini_file_uri
+        }
+    }
+
+def _try_load_image(image_path: str) -> Optional[dict]:
+
+    if not os.path.exists(image_path):
+        return None
+    
+    try:
+        return load_image(image_path)
+    except Exception as e:
+        print(f"Error loading image: {e}")
+        return None
+
+async def load_image_async(image_path: str) -> Optional[dict]:
+
+    async with image_load_semaphore:
+        return await asyncio.to_thread(_try_load_image, image_path)
+
+async def build_message_history(chat_history: List[Message], summary: Optional[str] = None) -> List[dict]:
 
     messages = []
     
-    for msg in chat_history[:-1]:  # Exclude the most recent user message (will be added separately)
+    # Older messages are represented by their summary
+    if summary:
+        messages.append({
+            "role": "user",
+            "parts": [f"Summary of our earlier conversation:\n{summary}"]
+        })
+        messages.append({
+            "role": "model",
+            "parts": ["Understood."]
+        })
+    
+    history = chat_history[:-1]  # Exclude the most recent user message (will be added separately)
+    
+    # Load images not yet uploaded to Gemini concurrently, off the event loop
+    image_paths = [
+        msg.image_path
+        for msg in history
+        if msg.image_path and not has_uploaded_file(msg)
+    ]
+    loaded_images = await asyncio.gather(*(load_image_async(path) for path in image_paths))
+    images = dict(zip(image_paths, loaded_images))
+    
+    for msg in history:
         # Map role: 'assistant' -> 'model' for Gemini
         role = "model" if msg.role == "assistant" else "user"
         
         parts = []
         
-        # Add image if present
-        if msg.image_path and os.path.exists(msg.image_path):
-            try:
-                image = load_image(msg.image_path)
-                parts.append(image)
-            except Exception as e:
-                print(f"Error loading image: {e}")
+        # Add image if present, preferring the copy already uploaded to Gemini
+        if msg.image_path and has_uploaded_file(msg):
+            parts.append(get_file_part(msg))
+        elif msg.image_path and images.get(msg.image_path) is not None:
+            parts.append(images[msg.image_path])
         
         # Add text content
         parts.append(msg.content)
@@ -68,38 +242,220 @@ def build_message_history(chat_history: List[Message]) -> List[dict]:
     
     return messages
 
+def estimate_tokens(history: List[dict]) -> int:
+
+    tokens = 0
+    for message in history:
+        for part in message["parts"]:
+            if isinstance(part, str):
+                tokens += len(part) // 4
+            else:
+                tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+def count_images(history: List[dict]) -> int:
+
+    return sum(
+        1
+        for message in history
+        for part in message["parts"]
+        if not isinstance(part, str)
+    )
+
+def _cache_is_valid(session: ChatSession, history: List[dict]) -> bool:
+
+    return (
+        session.cache_name is not None
+        and session.cache_version == CACHE_VERSION
+        and session.cache_expires_at is not None
+        and session.cache_expires_at > datetime.utcnow()
+        and session.cache_message_count <= len(history)
+        # A cache built before the latest summary covers a different history
+        and session.cache_summarized_message_id == session.summarized_message_id
+    )
+
+async def get_chat_model(
+    session: Optional[ChatSession],
+    history: List[dict]
+) -> Tuple[genai.GenerativeModel, List[dict]]:
+
+    if session is None:
+        return model, history
+    
+    # Reuse the cached prefix and only send the messages after it
+    if _cache_is_valid(session, history):
+        try:
+            cached_model = await asyncio.to_thread(
+                genai.GenerativeModel.from_cached_content,
+                session.cache_name,
+                generation_config=generation_config,
+                safety_settings=safety_settings
+            )
+            return cached_model, history[session.cache_message_count:]
+        except Exception as e:
+            print(f"Error loading cached content: {e}")
+    
+    session.cache_name = None
+    
+    if len(history) <= CACHE_MIN_MESSAGES or estimate_tokens(history) < CACHE_MIN_TOKENS:
+        return model, history
+    
+    # Cache the whole history so later turns only send the new messages
+    try:
+        expires_at = datetime.utcnow() + CACHE_TTL
+        cached_content = await asyncio.to_thread(
+            caching.CachedContent.create,
+            model=MODEL_NAME,
+            display_name=f"v{CACHE_VERSION}-chat:{session.id}",
+            contents=history,
+            ttl=CACHE_TTL
+        )
+    except Exception as e:
+        print(f"Error creating cached content: {e}")
+        return model, history
+    
+    session.cache_name = cached_content.name
+    session.cache_version = CACHE_VERSION
+    session.cache_message_count = len(history)
+    session.cache_summarized_message_id = session.summarized_message_id
+    session.cache_expires_at = expires_at
+    
+    cached_model = genai.GenerativeModel.from_cached_content(
+        cached_content,
+        generation_config=generation_config,
+        safety_settings=safety_settings
+    )
+    return cached_model, []
+
+def get_chat_key(session_id: int) -> str:
+
+    return f"v{CHAT_VERSION}-chat:{session_id}"
+
+def get_chat(
+    session: Optional[ChatSession],
+    chat_model: genai.GenerativeModel,
+    history: List[dict]
+) -> genai.ChatSession:
+
+    if session is None:
+        return chat_model.start_chat(history=history)
+    
+    # Reuse the chat while it still matches the stored history and cached prefix
+    key = get_chat_key(session.id)
+    state = (session.cache_name, session.summarized_message_id)
+    cached = chat_sessions.get(key)
+    if cached is not None:
+        cached_state, chat = cached
+        try:
+            if cached_state == state and len(chat.history) == len(history):
+                # Store again so its size reflects the turns added since
+                store_chat(key, state, chat)
+                return chat
+        except Exception:
+            pass  # A failed or interrupted reply leaves the chat history unusable
+    
+    chat = chat_model.start_chat(history=history)
+    store_chat(key, state, chat)
+    return chat
+
+def store_chat(key: str, state: tuple, chat: genai.ChatSession):
+
+    try:
+        chat_sessions[key] = (state, chat)
+    except ValueError:
+        # Larger than the whole cache, so rebuild it from the database each turn
+        chat_sessions.pop(key, None)
+
+def forget_chat(session_id: int):
+
+    chat_sessions.pop(get_chat_key(session_id), None)
+
+def needs_summary(message_count: int) -> bool:
+
+    return message_count >= HISTORY_WINDOW + SUMMARY_BATCH
+
+async def summarize_messages(summary: Optional[str], messages: List[Message]) -> str:
+
+    lines = []
+    if summary:
+        lines.append(f"Earlier summary:\n{summary}\n")
+    
+    for msg in messages:
+        speaker = "Assistant" if msg.role == "assistant" else "User"
+        image_note = " [shared an image]" if msg.image_path else ""
+        lines.append(f"{speaker}{image_note}: {msg.content}")
+    
+    prompt = f"{SUMMARY_PROMPT}\n\n" + "\n".join(lines)
+    
+    async with gemini_semaphore:
+        await rate_limiter.acquire(tokens=len(prompt) // 4)
+        response = await model.generate_content_async(prompt)
+    
+    return response.text
+
+async def send_with_retry(
+    chat: genai.ChatSession,
+    contents: List[dict],
+    parts: list
+) -> genai.types.AsyncGenerateContentResponse:
+
+    async for attempt in AsyncRetrying(
+        retry=retry_if_exception_type(RETRYABLE_ERRORS),
+        wait=wait_exponential_jitter(initial=1, max=16),
+        stop=stop_after_attempt(MAX_ATTEMPTS),
+        reraise=True
+    ):
+        with attempt:
+            # Released once the first chunk arrives, so replies stream concurrently.
+            # Image turns queue on the lock before taking a slot, leaving slots for text turns.
+            has_image = count_images([{"parts": parts}]) > 0
+            async with image_lock if has_image else nullcontext(), gemini_semaphore:
+                # Every attempt counts against the quota
+                await rate_limiter.acquire(
+                    tokens=estimate_tokens(contents),
+                    images=count_images(contents)
+                )
+                return await chat.send_message_async(parts, stream=True)
+
 async def process_chat_message(
     text: str,
     image_path: Optional[str] = None,
-    chat_history: List[Message] = None
-) -> str:
+    chat_history: List[Message] = None,
+    session: Optional[ChatSession] = None
+) -> AsyncIterator[str]:
 
     try:
         # Build message history
-        history = build_message_history(chat_history) if chat_history else []
+        summary = session.summary if session else None
+        history = await build_message_history(chat_history, summary) if chat_history else []
+        
+        # Use a cached prefix for long sessions
+        chat_model, history = await get_chat_model(session, history)
         
         # Build current message parts
         current_parts = []
         
-        # Add image if present
-        if image_path and os.path.exists(image_path):
-            try:
-                image = load_image(image_path)
+        # Add image if present, sending inline only if the upload failed
+        current_message = chat_history[-1] if chat_history else None
+        if image_path and current_message is not None and has_uploaded_file(current_message):
+            current_parts.append(get_file_part(current_message))
+        elif image_path:
+            image = await load_image_async(image_path)
+            if image is not None:
                 current_parts.append(image)
-            except Exception as e:
-                print(f"Error loading image: {e}")
         
         # Add text content
         current_parts.append(text)
         
-        # Start chat with history
-        chat = model.start_chat(history=history)
+        # Start chat with history, or continue the one from the previous turn
+        chat = get_chat(session, chat_model, history)
         
-        # Send message
-        response = chat.send_message(current_parts)
+        request_contents = history + [{"role": "user", "parts": current_parts}]
+        # Send message and stream the reply as it is generated
+        response = await send_with_retry(chat, request_contents, current_parts)
         
-        # Extract text from response
-        return response.text
+        async for chunk in response:
+            yield chunk.text
     
     except Exception as e:
         raise Exception(f"Error calling Gemini API: {str(e)}")
\ No newline at end of file
@@ -1,30 +1,38 @@
-from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form
+from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.staticfiles import StaticFiles
-from sqlalchemy.orm import Session
-from typing import Optional, List
+from sqlalchemy import delete, literal, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import load_only
+from typing import AsyncIterator, Optional, List
+import asyncio
+import json
 import os
 from datetime import datetime
 from pathlib import Path
 
-from database import get_db, engine
+from database import get_db, engine, migrate_schema, SessionLocal
 from models import Base, User, ChatSession, Message
 from schemas import UserCreate, UserLogin, TokenResponse, MessageResponse, ChatSessionResponse
-from auth import create_access_token, verify_token, get_password_hash, verify_password
-from llm_service import process_chat_message
-from file_handler import save_uploaded_image
-
-# Create tables
-Base.metadata.create_all(bind=engine)
+from auth import create_access_token, verify_token, get_password_hash, verify_password, DUMMY_HASH
+from llm_service import process_chat_message, upload_image, delete_uploaded_image, forget_chat, needs_summary, summarize_messages, HISTORY_WINDOW
+from file_handler import save_uploaded_image, delete_image, UploadSizeLimitMiddleware, UPLOAD_PATH
 
 app = FastAPI(title="Multimodal Chat API")
 
-# Create uploads directory if it doesn't exist
-Path("uploads").mkdir(parents=True, exist_ok=True)
+@app.on_event("startup")
+async def create_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(migrate_schema, Base.metadata)
+
+# When set, images are handed off to nginx via X-Accel-Redirect under this internal location
+X_ACCEL_REDIRECT_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX")
 
-# Mount static files for serving uploaded images
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
+# Oversize uploads are rejected before FastAPI spools the multipart body
+app.add_middleware(UploadSizeLimitMiddleware)
 
 # CORS
 app.add_middleware(
@@ -38,10 +46,11 @@ app.add_middleware(
 security = HTTPBearer()
 
 @app.post("/api/auth/register", response_model=TokenResponse)
-async def register(user_data: UserCreate, db: Session = Depends(get_db)):
+async def register(user_data: UserCreate, db: AsyncSession = Depends(get_db)):
 
     # Check if user exists
-    existing_user = db.query(User).filter(User.email == user_data.email).first()
+    result = await db.execute(select(User).where(User.email == user_data.email))
+    existing_user = result.scalars().first()
     if existing_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -53,8 +62,8 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
         hashed_password=hashed_password
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     
     # Generate token
     access_token = create_access_token(data={"sub": new_user.email, "user_id": new_user.id})
@@ -70,10 +79,12 @@ async def register(user_data: UserCreate, db: Session = Depends(get_db)):
     }
 
 @app.post("/api/auth/login", response_model=TokenResponse)
-async def login(user_data: UserLogin, db: Session = Depends(get_db)):
+async def login(user_data: UserLogin, db: AsyncSession = Depends(get_db)):
     """Login user"""
-    user = db.query(User).filter(User.email == user_data.email).first()
-    if not user or not verify_password(user_data.password, user.hashed_password):
+    result = await db.execute(select(User).where(User.email == user_data.email))
+    user = result.scalars().first()
+    valid = verify_password(user_data.password, user.hashed_password if user else DUMMY_HASH)
+    if not user or not valid:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     access_token = create_access_token(data={"sub": user.email, "user_id": user.id})
@@ -90,7 +101,7 @@ async def login(user_data: UserLogin, db: Session = Depends(get_db)):
 
 async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get current authenticated user"""
     token = credentials.credentials
@@ -100,7 +111,8 @@ async def get_current_user(
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     
     user_id = payload.get("user_id")
-    user = db.query(User).filter(User.id == user_id).first()
+    result = await db.execute(select(User).where(User.id == user_id))
+    user = result.scalars().first()
     
     if user is None:
         raise HTTPException(status_code=401, detail="User not found")
@@ -111,7 +123,7 @@ async def get_current_user(
 async def create_chat_session(
     title: Optional[str] = None,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Create a new chat session"""
     session = ChatSession(
@@ -119,130 +131,307 @@ async def create_chat_session(
         title=title or f"Chat {datetime.now().strftime('%Y-%m-%d %H:%M')}"
     )
     db.add(session)
-    db.commit()
-    db.refresh(session)
+    await db.commit()
+    await db.refresh(session)
     
     return session
 
 @app.get("/api/chat/sessions", response_model=List[ChatSessionResponse])
 async def get_chat_sessions(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get all chat sessions for the current user"""
-    sessions = db.query(ChatSession).filter(
-        ChatSession.user_id == current_user.id
-    ).order_by(ChatSession.updated_at.desc()).all()
+    result = await db.execute(
+        select(ChatSession).options(
+            load_only(
+                ChatSession.id,
+                ChatSession.user_id,
+                ChatSession.title,
+                ChatSession.created_at,
+                ChatSession.updated_at
+            )
+        ).where(
+            ChatSession.user_id == current_user.id
+        ).order_by(ChatSession.updated_at.desc())
+    )
     
-    return sessions
+    return result.scalars().all()
 
 @app.get("/api/chat/sessions/{session_id}/messages", response_model=List[MessageResponse])
 async def get_session_messages(
     session_id: int,
+    limit: Optional[int] = Query(None, ge=1),
+    offset: int = Query(0, ge=0),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Get all messages for a specific chat session"""
     # Verify session belongs to user
-    session = db.query(ChatSession).filter(
-        ChatSession.id == session_id,
-        ChatSession.user_id == current_user.id
-    ).first()
+    result = await db.execute(
+        select(literal(1)).where(
+            ChatSession.id == session_id,
+            ChatSession.user_id == current_user.id
+        ).limit(1)
+    )
     
-    if not session:
+    if not result.scalar():
         raise HTTPException(status_code=404, detail="Session not found")
     
-    messages = db.query(Message).filter(
-        Message.session_id == session_id
-    ).order_by(Message.created_at).all()
+    result = await db.execute(
+        select(Message).options(
+            load_only(
+                Message.id,
+                Message.session_id,
+                Message.role,
+                Message.content,
+                Message.image_path,
+                Message.created_at
+            )
+        ).where(
+            Message.session_id == session_id
+        ).order_by(Message.created_at).offset(offset).limit(limit)
+    )
     
-    return messages
+    return result.scalars().all()
 
-@app.post("/api/chat/sessions/{session_id}/messages", response_model=MessageResponse)
+@app.post("/api/chat/sessions/{session_id}/messages")
 async def send_message(
     session_id: int,
     text: str = Form(...),
     image: Optional[UploadFile] = File(None),
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user)
 ):
     """Send a message with optional image to a chat session"""
-    # Verify session belongs to user
-    session = db.query(ChatSession).filter(
-        ChatSession.id == session_id,
-        ChatSession.user_id == current_user.id
-    ).first()
-    
-    if not session:
-        raise HTTPException(status_code=404, detail="Session not found")
-    
-    # Handle image upload
+    # Nothing is written until the reply has streamed, then the turn is committed at once.
+    # The request-scoped session is closed before streaming, so use our own.
+    db = SessionLocal()
     image_path = None
-    if image:
-        image_path = await save_uploaded_image(image, current_user.id, session_id)
-    
-    # Save user message
-    user_message = Message(
-        session_id=session_id,
-        role="user",
-        content=text,
-        image_path=image_path
-    )
-    db.add(user_message)
-    db.commit()
-    db.refresh(user_message)
-    
-    # Get chat history for context
-    previous_messages = db.query(Message).filter(
-        Message.session_id == session_id
-    ).order_by(Message.created_at).all()
-    
-    # Process with LLM
+    user_message = None
     try:
-        assistant_response = await process_chat_message(
+        # Verify session belongs to user
+        result = await db.execute(
+            select(ChatSession).where(
+                ChatSession.id == session_id,
+                ChatSession.user_id == current_user.id
+            )
+        )
+        session = result.scalars().first()
+        
+        if not session:
+            raise HTTPException(status_code=404, detail="Session not found")
+        
+        # Handle image upload
+        if image:
+            image_path = await save_uploaded_image(image, current_user.id, session_id)
+        
+        # The user message is only kept in memory until the reply is complete
+        user_message = Message(
+            session_id=session_id,
+            role="user",
+            content=text,
+            image_path=image_path,
+            created_at=datetime.utcnow()
+        )
+        
+        # Get the messages not yet covered by the session summary while the image is
+        # uploaded once, so later turns can reference it instead of resending it
+        history_query = db.execute(
+            select(Message).where(
+                Message.session_id == session_id,
+                Message.id > (session.summarized_message_id or 0)
+            ).order_by(Message.created_at)
+        )
+        if image_path:
+            _, result = await asyncio.gather(
+                upload_image(image_path, user_message),
+                history_query
+            )
+        else:
+            result = await history_query
+        chat_history = [*result.scalars().all(), user_message]
+        
+        # End the read transaction so no connection or lock is held while Gemini replies
+        await db.commit()
+        
+        # Process with LLM, waiting for the first chunk so failures still return an error status
+        reply = process_chat_message(
             text=text,
             image_path=image_path,
-            chat_history=previous_messages
+            chat_history=chat_history,
+            session=session
         )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"LLM processing error: {str(e)}")
-    
-    # Save assistant message
-    assistant_message = Message(
-        session_id=session_id,
-        role="assistant",
-        content=assistant_response
-    )
-    db.add(assistant_message)
+        try:
+            first_chunk = await anext(reply, "")
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"LLM processing error: {str(e)}")
+    except BaseException:
+        await db.close()
+        await discard_turn_images(image_path, user_message)
+        raise
     
-    # Update session timestamp
-    session.updated_at = datetime.utcnow()
+    # Fold older messages into the summary once the reply has been sent
+    background = None
+    if needs_summary(len(chat_history) + 1):
+        background = BackgroundTask(update_session_summary, session_id)
     
-    db.commit()
-    db.refresh(assistant_message)
+    return StreamingResponse(
+        stream_assistant_reply(db, session, user_message, first_chunk, reply),
+        media_type="text/event-stream",
+        background=background
+    )
+
+def format_event(data: str, event: Optional[str] = None) -> str:
+
+    lines = [f"event: {event}"] if event else []
+    lines.append(f"data: {data}")
+    return "\n".join(lines) + "\n\n"
+
+async def stream_assistant_reply(
+    db: AsyncSession,
+    session: ChatSession,
+    user_message: Message,
+    first_chunk: str,
+    reply: AsyncIterator[str]
+) -> AsyncIterator[str]:
+    """Stream the assistant reply as server-sent events and commit the turn once complete"""
+    committed = False
+    try:
+        chunks = [first_chunk]
+        yield format_event(json.dumps(first_chunk))
+        
+        try:
+            async for chunk in reply:
+                chunks.append(chunk)
+                yield format_event(json.dumps(chunk))
+        except Exception as e:
+            yield format_event(json.dumps(f"LLM processing error: {str(e)}"), event="error")
+            return
+        
+        # Save assistant message with its timestamp set here, so the response
+        # needs no refresh after commit
+        now = datetime.utcnow()
+        assistant_message = Message(
+            session_id=session.id,
+            role="assistant",
+            content="".join(chunks),
+            created_at=now
+        )
+        db.add_all([user_message, assistant_message])
+        
+        # Update session timestamp
+        session.updated_at = now
+        
+        await db.commit()
+        committed = True
+        
+        message = MessageResponse.model_validate(assistant_message)
+        yield format_event(message.model_dump_json(), event="message")
+    finally:
+        # Nothing from a failed turn was ever written, but its image files were
+        await db.close()
+        if not committed:
+            await discard_turn_images(user_message.image_path, user_message)
+
+async def discard_turn_images(image_path: Optional[str], user_message: Optional[Message]):
+    """Remove the stored and uploaded image of a turn that was never committed"""
+    if image_path is None:
+        return
     
-    return assistant_message
+    await asyncio.to_thread(delete_image, image_path)
+    if user_message is not None and user_message.gemini_file_name is not None:
+        await delete_uploaded_image(user_message.gemini_file_name)
+
+async def update_session_summary(session_id: int):
+    """Summarize the messages that have fallen out of the history window"""
+    async with SessionLocal() as db:
+        session = await db.get(ChatSession, session_id)
+        if session is None:
+            return
+        
+        result = await db.execute(
+            select(Message).where(
+                Message.session_id == session_id,
+                Message.id > (session.summarized_message_id or 0)
+            ).order_by(Message.created_at)
+        )
+        messages = result.scalars().all()
+        
+        if not needs_summary(len(messages)):
+            return
+        
+        older_messages = messages[:-HISTORY_WINDOW]
+        try:
+            summary = await summarize_messages(session.summary, older_messages)
+        except Exception as e:
+            print(f"Error summarizing session: {e}")
+            return
+        
+        session.summary = summary
+        session.summarized_message_id = older_messages[-1].id
+        
+        # The cached history prefix included the old summary and messages
+        session.cache_name = None
+        
+        await db.commit()
 
 @app.delete("/api/chat/sessions/{session_id}")
 async def delete_chat_session(
     session_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Delete a chat session and all its messages"""
-    session = db.query(ChatSession).filter(
+    owned_session = select(ChatSession.id).where(
         ChatSession.id == session_id,
         ChatSession.user_id == current_user.id
-    ).first()
+    )
+    
+    # Bulk deletes skip the ORM cascade, so remove the messages first
+    await db.execute(
+        delete(Message).where(Message.session_id.in_(owned_session))
+    )
+    result = await db.execute(
+        delete(ChatSession).where(
+            ChatSession.id == session_id,
+            ChatSession.user_id == current_user.id
+        )
+    )
     
-    if not session:
+    if result.rowcount != 1:
+        await db.rollback()
         raise HTTPException(status_code=404, detail="Session not found")
     
-    db.delete(session)
-    db.commit()
+    await db.commit()
+    forget_chat(session_id)
     
     return {"message": "Session deleted successfully"}
 
+@app.get("/api/images/{user_id}/{session_id}/{name}")
+async def get_image(
+    user_id: int,
+    session_id: int,
+    name: str,
+    current_user: User = Depends(get_current_user)
+):
+    """Serve an uploaded image to the user who owns it"""
+    if user_id != current_user.id or name != Path(name).name or name.startswith("."):
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    relative_path = f"{user_id}/{session_id}/{name}"
+    
+    # Let nginx send the file so Python stays out of the byte path
+    if X_ACCEL_REDIRECT_PREFIX:
+        return Response(headers={"X-Accel-Redirect": f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{relative_path}"})
+    
+    image_path = UPLOAD_PATH / relative_path
+    try:
+        stat_result = await asyncio.to_thread(os.stat, image_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    
+    return FileResponse(image_path, stat_result=stat_result)
+
 @app.get("/api/health")
 async def health_check():
     """Health check endpoint"""
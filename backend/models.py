@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base
@@ -24,6 +24,17 @@ class ChatSession(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # Summary of the messages up to and including summarized_message_id
+    summary = Column(Text, nullable=True)
+    summarized_message_id = Column(Integer, nullable=True)
+    
+    # Gemini context cache for the history prefix
+    cache_name = Column(String, nullable=True)
+    cache_version = Column(Integer, nullable=True)
+    cache_message_count = Column(Integer, nullable=True)
+    cache_summarized_message_id = Column(Integer, nullable=True)  # Summary boundary the cache was built on
+    cache_expires_at = Column(DateTime, nullable=True)
+    
     # Relationships
     user = relationship("User", back_populates="chat_sessions")
     messages = relationship("Message", back_populates="session", cascade="all, delete-orphan")
@@ -36,7 +47,14 @@ class Message(Base):
     role = Column(String, nullable=False)  # "user" or "assistant"
     content = Column(Text, nullable=False)
     image_path = Column(String, nullable=True)  # Path to uploaded image
+    gemini_file_name = Column(String, nullable=True)  # Image uploaded to the Gemini Files API
+    gemini_file_uri = Column(String, nullable=True)
+    gemini_file_expires_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     
     # Relationships
-    session = relationship("ChatSession", back_populates="messages")
\ No newline at end of file
+    session = relationship("ChatSession", back_populates="messages")
+
+# Composite indexes for the hot query paths
+Index("ix_messages_session_created", Message.session_id, Message.created_at)
+Index("ix_sessions_user_updated", ChatSession.user_id, ChatSession.updated_at.desc())
\ No newline at end of file
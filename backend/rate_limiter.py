@@ -0,0 +1,61 @@
+import asyncio
+import time
+from typing import Dict
+
+class TokenBucket:
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period  # Tokens refilled per second
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: int) -> float:
+        # A single request larger than the bucket waits for a full bucket
+        amount = min(amount, self.capacity)
+        self._refill()
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: int):
+        self.tokens -= min(amount, self.capacity)
+
+class RateLimiter:
+    """Token buckets across requests, tokens and images per minute and requests per day"""
+
+    def __init__(self, rpm: int, tpm: int, rpd: int, ipm: int):
+        self.buckets = {
+            "requests": TokenBucket(rpm, 60),
+            "tokens": TokenBucket(tpm, 60),
+            "daily_requests": TokenBucket(rpd, 24 * 60 * 60),
+            "images": TokenBucket(ipm, 60),
+        }
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int = 0, images: int = 0):
+        amounts: Dict[str, int] = {
+            "requests": 1,
+            "tokens": tokens,
+            "daily_requests": 1,
+            "images": images,
+        }
+        
+        # Waiters queue on the lock so bursts are released in order
+        async with self._lock:
+            while True:
+                wait = max(
+                    bucket.wait_time(amounts[name])
+                    for name, bucket in self.buckets.items()
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            
+            for name, bucket in self.buckets.items():
+                bucket.consume(amounts[name])
\ No newline at end of file
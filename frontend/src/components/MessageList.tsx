@@ -1,6 +1,10 @@
+import { useState, useEffect } from 'react';
+import axios from 'axios';
 import { User, Bot } from 'lucide-react';
 import './MessageList.css';
 
+const API_URL = import.meta.env.VITE_API_URL || 'http://localhost:8000';
+
 interface Message {
   id: number;
   role: string;
@@ -13,6 +17,35 @@ interface MessageListProps {
   messages: Message[];
 }
 
+// Images are served by an authenticated endpoint, so fetch them with the auth header
+function AuthImage({ imagePath }: { imagePath: string }) {
+  const [src, setSrc] = useState<string | null>(null);
+
+  useEffect(() => {
+    let objectUrl: string | null = null;
+    let cancelled = false;
+
+    axios
+      .get(`${API_URL}/api/images/${imagePath.replace(/^uploads\//, '')}`, { responseType: 'blob' })
+      .then((response) => {
+        if (!cancelled) {
+          objectUrl = URL.createObjectURL(response.data);
+          setSrc(objectUrl);
+        }
+      })
+      .catch((error) => console.error('Failed to load image:', error));
+
+    return () => {
+      cancelled = true;
+      if (objectUrl) {
+        URL.revokeObjectURL(objectUrl);
+      }
+    };
+  }, [imagePath]);
+
+  return src ? <img src={src} alt="Uploaded" loading="lazy" /> : null;
+}
+
 export default function MessageList({ messages }: MessageListProps) {
   if (messages.length === 0) {
     return (
@@ -36,11 +69,7 @@ export default function MessageList({ messages }: MessageListProps) {
           <div className="message-content">
             {message.image_path && (
               <div className="message-image">
-                <img
-                  src={`http://localhost:8000/${message.image_path}`}
-                  alt="Uploaded"
-                  loading="lazy"
-                />
+                <AuthImage imagePath={message.image_path} />
               </div>
             )}
             
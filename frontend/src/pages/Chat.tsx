@@ -122,24 +122,70 @@ export default function Chat() {
         formData.append('image', image);
       }
 
-      const response = await axios.post(
+      // Show the user message and the reply as it streams in
+      const now = new Date().toISOString();
+      setMessages(prev => [
+        ...prev,
+        { id: -1, session_id: currentSession.id, role: 'user', content: text, image_path: null, created_at: now },
+        { id: -2, session_id: currentSession.id, role: 'assistant', content: '', image_path: null, created_at: now },
+      ]);
+
+      // fetch rather than axios so the server-sent events can be read as they arrive
+      const response = await fetch(
         `${API_URL}/api/chat/sessions/${currentSession.id}/messages`,
-        formData,
         {
+          method: 'POST',
           headers: {
-            'Content-Type': 'multipart/form-data',
+            Authorization: `Bearer ${localStorage.getItem('token')}`,
           },
+          body: formData,
         }
       );
 
-      // Refresh messages to get both user and assistant messages
+      if (!response.ok || !response.body) {
+        const data = await response.json().catch(() => null);
+        throw new Error(data?.detail || `Request failed with status ${response.status}`);
+      }
+
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+
+      while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        // Events are separated by a blank line
+        const events = buffer.split('\n\n');
+        buffer = events.pop() ?? '';
+
+        for (const raw of events) {
+          let event = 'chunk';
+          let data = '';
+          for (const line of raw.split('\n')) {
+            if (line.startsWith('event: ')) event = line.slice(7);
+            else if (line.startsWith('data: ')) data += line.slice(6);
+          }
+
+          if (event === 'error') {
+            throw new Error(JSON.parse(data));
+          }
+          if (event === 'chunk') {
+            const chunk: string = JSON.parse(data);
+            setMessages(prev => prev.map(m => (m.id === -2 ? { ...m, content: m.content + chunk } : m)));
+          }
+        }
+      }
+    } catch (error) {
+      console.error('Failed to send message:', error);
+      alert(`Failed to send message: ${error instanceof Error ? error.message : error}`);
+    } finally {
+      // Replace the streamed placeholders with the stored messages, or drop them after a failure
       await fetchMessages(currentSession.id);
       
       // Update sessions list to reflect new timestamp
       await fetchSessions();
-    } catch (error) {
-      console.error('Failed to send message:', error);
-    } finally {
       setSending(false);
     }
   };